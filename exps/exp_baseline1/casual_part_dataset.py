@@ -5,6 +5,10 @@ import pandas as pd
 import torch
 from torch.utils.data import Dataset
 from sapien_const import NO_CASUAL, SELF_CASUAL, BINARY_CASUAL, OBJ_NUM
+import utils
+
+# npoint of the first two SA modules in models.model_v2.PointNet2
+FPS_NPOINTS = (512, 128)
 
 
 class CasualPartDataset(Dataset):
@@ -12,33 +16,58 @@ class CasualPartDataset(Dataset):
         self.no_casual_num = no_casual_num
         self.self_casual_num = self_casual_num
         self.binary_casual_num = binary_casual_num
+        self.fps_cache = {}
+        # the slot layout is fixed, so the dataset length never changes; a
+        # persistent per-copy generator (seeded per worker in
+        # utils.worker_init_fn) drives all scene sampling, so epochs need no
+        # reset() and the workers can stay alive across epochs
+        self.obj_num = no_casual_num + self_casual_num + 2 * binary_casual_num
+        self.rng = random.Random()
         self.reset()
 
+    def seed(self, seed):
+        self.rng.seed(seed)
+
     def reset(self):
         self.sapien_indices= []
         self.obj_groups = []
 
         # for i in range(np.random.randint(1, self.no_casual_num+1)):
         for i in range(self.no_casual_num):
-            OBJ = random.choice(NO_CASUAL)
-            self.sapien_indices.append(random.choice(OBJ.sapien_id))
+            OBJ = self.rng.choice(NO_CASUAL)
+            self.sapien_indices.append(self.rng.choice(OBJ.sapien_id))
             self.obj_groups.append(OBJ)
 
         # for i in range(np.random.randint(1, self.self_casual_num+1)):
         for i in range(self.self_casual_num):
-            OBJ, _, _ = random.choice(SELF_CASUAL)
-            self.sapien_indices.append(random.choice(OBJ.sapien_id))
+            OBJ, _, _ = self.rng.choice(SELF_CASUAL)
+            self.sapien_indices.append(self.rng.choice(OBJ.sapien_id))
             self.obj_groups.append(OBJ)
 
         # for i in range(np.random.randint(1, self.self_casual_num+1)):
         for i in range(self.binary_casual_num):
-            SRC, _, DST, _ = random.choice(BINARY_CASUAL)
-            self.sapien_indices.append(random.choice(SRC.sapien_id))
-            self.sapien_indices.append(random.choice(DST.sapien_id))
+            SRC, _, DST, _ = self.rng.choice(BINARY_CASUAL)
+            self.sapien_indices.append(self.rng.choice(SRC.sapien_id))
+            self.sapien_indices.append(self.rng.choice(DST.sapien_id))
             self.obj_groups.append(SRC)
             self.obj_groups.append(DST)
 
-        self.obj_num = len(self.obj_groups)
+    def sample_slot(self, slot):
+        # draw a fresh object for one scene slot; the layout matches reset():
+        # no-casual slots first, then self-casual, then SRC/DST pairs
+        if slot < self.no_casual_num:
+            OBJ = self.rng.choice(NO_CASUAL)
+        elif slot < self.no_casual_num + self.self_casual_num:
+            OBJ, _, _ = self.rng.choice(SELF_CASUAL)
+        else:
+            SRC, _, DST, _ = self.rng.choice(BINARY_CASUAL)
+            OBJ = SRC if (slot - self.no_casual_num - self.self_casual_num) % 2 == 0 else DST
+        return OBJ, self.rng.choice(OBJ.sapien_id)
+
+    def binary_pair_id(self, slot):
+        # binary slots come in SRC/DST pairs after the no/self-casual slots
+        base = slot - self.no_casual_num - self.self_casual_num
+        return base // 2 if base >= 0 else None
 
     def __len__(self):
         return self.obj_num * self.obj_num
@@ -63,17 +92,42 @@ class CasualPartDataset(Dataset):
         tgt = torch.from_numpy(tgt).float().squeeze()
         return pc, src, tgt
 
+    # the point cloud on disk is fixed per shape, so the FPS indices for the
+    # first two SA modules can be computed once on the CPU workers and cached,
+    # taking the serial farthest-point sampling off the GPU's critical path
+    def get_fps_idx(self, idx, pc):
+        if idx not in self.fps_cache:
+            xyz = pc.numpy()
+            idx_1 = utils.farthest_point_sample_cpu(xyz, FPS_NPOINTS[0])
+            idx_2 = utils.farthest_point_sample_cpu(xyz[idx_1], FPS_NPOINTS[1])
+            self.fps_cache[idx] = (torch.from_numpy(idx_1), torch.from_numpy(idx_2))
+        return self.fps_cache[idx]
+
     def __getitem__(self, idx):
         i = idx // self.obj_num
         j = idx % self.obj_num
 
-        obj_i = self.obj_groups[i]
-        obj_j = self.obj_groups[j]
-        idx_i = self.sapien_indices[i]
-        idx_j = self.sapien_indices[j]
+        # keep the baseline scene structure: diagonal items compare an object
+        # with itself (the guaranteed self-casual positives), and the two
+        # slots of one binary pair share a single relation draw so the
+        # guaranteed SRC/DST positive survives the per-item resampling
+        pair_i = self.binary_pair_id(i)
+        if i == j:
+            obj_i, idx_i = self.sample_slot(i)
+            obj_j, idx_j = obj_i, idx_i
+        elif pair_i is not None and pair_i == self.binary_pair_id(j):
+            SRC, _, DST, _ = self.rng.choice(BINARY_CASUAL)
+            obj_i, obj_j = (SRC, DST) if i < j else (DST, SRC)
+            idx_i = self.rng.choice(obj_i.sapien_id)
+            idx_j = self.rng.choice(obj_j.sapien_id)
+        else:
+            obj_i, idx_i = self.sample_slot(i)
+            obj_j, idx_j = self.sample_slot(j)
 
         pc_i, src_i, tgt_i = self.load_data(idx_i)
         pc_j, key_j, tgt_j = self.load_data(idx_j)
+        fps_i_1, fps_i_2 = self.get_fps_idx(idx_i, pc_i)
+        fps_j_1, fps_j_2 = self.get_fps_idx(idx_j, pc_j)
         if self.check_relation(obj_i, obj_j):
             key_i = src_i
             key_j = tgt_j
@@ -83,7 +137,7 @@ class CasualPartDataset(Dataset):
 
         onehot_i = torch.zeros(OBJ_NUM); onehot_i[obj_i.idx] = 1
         onehot_j = torch.zeros(OBJ_NUM); onehot_j[obj_j.idx] = 1
-        return onehot_i, onehot_j, pc_i, pc_j, key_i, key_j
+        return onehot_i, onehot_j, pc_i, pc_j, key_i, key_j, fps_i_1, fps_i_2, fps_j_1, fps_j_2
 
     def relation_graph(self):
         graph = torch.zeros(self.obj_num, self.obj_num, dtype=torch.bool)
@@ -106,6 +160,8 @@ class CasualRelationDataset(CasualPartDataset):
         self.no_casual_num = no_casual_num
         self.self_casual_num = self_casual_num
         self.binary_casual_num = binary_casual_num
+        self.obj_num = no_casual_num + self_casual_num + 2 * binary_casual_num
+        self.rng = random.Random()
 
     def __len__(self):
         return 1
@@ -4,8 +4,8 @@ import torch.nn.functional as F
 import sys, os
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(BASE_DIR, '../utils'))
-from cd.chamfer import chamfer_distance
-from emd.emd import earth_mover_distance
+from cd.chamfer import chamfer_distance, chamfer_fast
+from emd.emd import earth_mover_distance, sinkhorn_emd
 
 
 class PointNet(nn.Module):
@@ -63,12 +63,14 @@ class Sampler(nn.Module):
 
         if self.probabilistic:
             logvar = self.mlp2var(encode)
-            std = logvar.mul(0.5).exp_()
+            # out-of-place functional form: fuses into a single pointwise
+            # kernel under torch.compile and reuses std*std for exp(logvar)
+            std = (0.5 * logvar).exp()
             eps = torch.randn_like(std)
 
-            kld = mu.pow(2).add_(logvar.exp()).mul_(-1).add_(1).add_(logvar)
+            kld = 1 + logvar - mu.pow(2) - std.pow(2)
 
-            return torch.cat([eps.mul(std).add_(mu), kld], 1)
+            return mu + eps * std, kld.sum(dim=1)
         else:
             return mu
 
@@ -123,6 +125,10 @@ class FCUpconvDecoder(nn.Module):
         self.deconv4 = nn.ConvTranspose2d(256, 128, 5, 3)
         self.deconv5 = nn.ConvTranspose2d(128, 3, 1, 1)
 
+        # NHWC layout lets cuDNN pick its tensor-core kernels for the deconvs
+        # instead of transposing NCHW activations internally
+        self.to(memory_format=torch.channels_last)
+
     def forward(self, feat):
         batch_size = feat.shape[0]
 
@@ -131,7 +137,7 @@ class FCUpconvDecoder(nn.Module):
         fc_net = torch.relu(self.mlp2(fc_net))
         fc_net = self.mlp3(fc_net).view(batch_size, -1, 3)
 
-        upconv_net = feat.view(batch_size, -1, 1, 1)
+        upconv_net = feat.view(batch_size, -1, 1, 1).contiguous(memory_format=torch.channels_last)
         upconv_net = torch.relu(self.deconv1(upconv_net))
         upconv_net = torch.relu(self.deconv2(upconv_net))
         upconv_net = torch.relu(self.deconv3(upconv_net))
@@ -169,22 +175,29 @@ class Network(nn.Module):
     """
     def forward(self, input_pcs):
         feats = self.encoder(input_pcs)
-        feats = self.sample_encoder(feats)
         ret_list = dict()
         if self.conf.probabilistic:
-            feats, obj_kldiv_loss = torch.chunk(feats, 2, 1)
-            ret_list['kldiv_loss'] = -obj_kldiv_loss.sum(dim=1)
+            feats, obj_kldiv_loss = self.sample_encoder(feats)
+            ret_list['kldiv_loss'] = -obj_kldiv_loss
+        else:
+            feats = self.sample_encoder(feats)
         feats = self.sample_decoder(feats)
         output_pcs = self.decoder(feats)
         return output_pcs, feats, ret_list
     
     def get_loss(self, pc1, pc2):
         if self.conf.loss_type == 'cd':
-            dist1, dist2 = chamfer_distance(pc1, pc2, transpose=False)
+            if getattr(self.conf, 'legacy_cd', False):
+                dist1, dist2 = chamfer_distance(pc1, pc2, transpose=False)
+            else:
+                dist1, dist2 = chamfer_fast(pc1, pc2, transpose=False)
             loss_per_data = torch.mean(dist1, dim=1) + torch.mean(dist2, dim=1)
 
         elif self.conf.loss_type == 'emd':
-            loss_per_data = earth_mover_distance(pc1, pc2, transpose=False) / min(pc1.shape[1], pc2.shape[1])
+            if getattr(self.conf, 'emd_impl', 'approx') == 'sinkhorn':
+                loss_per_data = sinkhorn_emd(pc1, pc2, transpose=False) / min(pc1.shape[1], pc2.shape[1])
+            else:
+                loss_per_data = earth_mover_distance(pc1, pc2, transpose=False) / min(pc1.shape[1], pc2.shape[1])
 
         else:
             raise ValueError('ERROR: unknown loss_type %s!' % loss_type)
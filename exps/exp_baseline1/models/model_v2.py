@@ -4,28 +4,53 @@ import torch.nn.functional as F
 import sys, os
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(BASE_DIR, '../utils'))
-from cd.chamfer import chamfer_distance
-from emd.emd import earth_mover_distance
+from cd.chamfer import chamfer_distance, chamfer_fast
+from emd.emd import earth_mover_distance, sinkhorn_emd
 
 from pointnet2_ops import pointnet2_utils
 from pointnet2_ops.pointnet2_modules import PointnetFPModule, PointnetSAModule
 from pointnet2.models.pointnet2_ssg_cls import PointNet2ClassificationSSG
+from .pointnet2_fast import patch_ball_query, ensure_cuda_ops
 from .pointnet import PointNet
 
+patch_ball_query()
+
+class PresampledSAModule(PointnetSAModule):
+    # PointnetSAModule that can skip the on-GPU farthest-point sampling when
+    # the caller already computed the sample indices (e.g. on the CPU
+    # dataloader workers, where FPS runs in parallel with GPU compute)
+    def forward(self, xyz, features=None, fps_idx=None):
+        if fps_idx is None:
+            return super(PresampledSAModule, self).forward(xyz, features)
+
+        xyz_flipped = xyz.transpose(1, 2).contiguous()
+        new_xyz = pointnet2_utils.gather_operation(xyz_flipped, fps_idx.int()).transpose(1, 2).contiguous()
+
+        new_features_list = []
+        for i in range(len(self.groupers)):
+            new_features = self.groupers[i](xyz, new_xyz, features)
+            new_features = self.mlps[i](new_features)
+            new_features = F.max_pool2d(new_features, kernel_size=[1, new_features.size(3)])
+            new_features = new_features.squeeze(-1)
+            new_features_list.append(new_features)
+
+        return new_xyz, torch.cat(new_features_list, dim=1)
+
+
 class PointNet2(PointNet2ClassificationSSG):
     def _build_model(self):
         self.SA_modules = nn.ModuleList()
         self.SA_modules.append(
-            PointnetSAModule(
+            PresampledSAModule(
                 npoint=512,
                 radius=0.2,
                 nsample=64,
-                mlp=[3, 64, 64, 128],
+                mlp=[0, 64, 64, 128],
                 use_xyz=True,
             )
         )
         self.SA_modules.append(
-            PointnetSAModule(
+            PresampledSAModule(
                 npoint=128,
                 radius=0.4,
                 nsample=64,
@@ -46,7 +71,7 @@ class PointNet2(PointNet2ClassificationSSG):
             nn.ReLU(True),
         )
 
-    def forward(self, pointcloud):
+    def forward(self, pointcloud, fps_idxs=None):
         r"""
             Forward pass of the network
 
@@ -57,16 +82,25 @@ class PointNet2(PointNet2ClassificationSSG):
                 Point cloud to run predicts on
                 Each point in the point-cloud MUST
                 be formated as (x, y, z, features...)
+            fps_idxs: optional tuple of precomputed FPS index tensors for the
+                first SA modules (one per module, B x npoint each)
         """
         xyz, features = self._break_up_pc(pointcloud)
 
-        l_xyz, l_features = [xyz], [features]
-        for i in range(len(self.SA_modules)):
-            li_xyz, li_features = self.SA_modules[i](l_xyz[i], l_features[i])
-            l_xyz.append(li_xyz)
-            l_features.append(li_features)
-
-        bottleneck_feats = l_features[-1].squeeze(-1)
+        # the pointnet2_ops kernels (grouping/gather) are float32-only, so the
+        # SA stack must stay out of any ambient autocast region; the fc head
+        # below still runs under the caller's autocast dtype
+        with torch.autocast(device_type=xyz.device.type, enabled=False):
+            l_xyz, l_features = [xyz], [features]
+            for i in range(len(self.SA_modules)):
+                if fps_idxs is not None and i < len(fps_idxs):
+                    li_xyz, li_features = self.SA_modules[i](l_xyz[i], l_features[i], fps_idx=fps_idxs[i])
+                else:
+                    li_xyz, li_features = self.SA_modules[i](l_xyz[i], l_features[i])
+                l_xyz.append(li_xyz)
+                l_features.append(li_features)
+
+            bottleneck_feats = l_features[-1].squeeze(-1)
 
         return self.fc_layer2(bottleneck_feats)
 
@@ -87,12 +121,14 @@ class Sampler(nn.Module):
 
         if self.probabilistic:
             logvar = self.mlp2var(encode)
-            std = logvar.mul(0.5).exp_()
+            # out-of-place functional form: fuses into a single pointwise
+            # kernel under torch.compile and reuses std*std for exp(logvar)
+            std = (0.5 * logvar).exp()
             eps = torch.randn_like(std)
 
-            kld = mu.pow(2).add_(logvar.exp()).mul_(-1).add_(1).add_(logvar)
+            kld = 1 + logvar - mu.pow(2) - std.pow(2)
 
-            return torch.cat([eps.mul(std).add_(mu), kld], 1)
+            return mu + eps * std, kld.sum(dim=1)
         else:
             return mu
 
@@ -148,6 +184,10 @@ class FCUpconvDecoder(nn.Module):
         self.deconv4 = nn.ConvTranspose2d(256, 128, 5, 3)
         self.deconv5 = nn.ConvTranspose2d(128, dim, 1, 1)
 
+        # NHWC layout lets cuDNN pick its tensor-core kernels for the deconvs
+        # instead of transposing NCHW activations internally
+        self.to(memory_format=torch.channels_last)
+
     def forward(self, feat):
         batch_size = feat.shape[0]
 
@@ -156,7 +196,7 @@ class FCUpconvDecoder(nn.Module):
         fc_net = torch.relu(self.mlp2(fc_net))
         fc_net = self.mlp3(fc_net).view(batch_size, -1, self.dim)
 
-        upconv_net = feat.view(batch_size, -1, 1, 1)
+        upconv_net = feat.view(batch_size, -1, 1, 1).contiguous(memory_format=torch.channels_last)
         upconv_net = torch.relu(self.deconv1(upconv_net))
         upconv_net = torch.relu(self.deconv2(upconv_net))
         upconv_net = torch.relu(self.deconv3(upconv_net))
@@ -172,6 +212,7 @@ class Network(nn.Module):
     def __init__(self, conf):
         super(Network, self).__init__()
         self.conf = conf
+        conf.use_torch_fps = not ensure_cuda_ops()
 
         self.encoder = PointNet2({'feat_dim': 128})
 
@@ -192,23 +233,30 @@ class Network(nn.Module):
         Output: B x N x 3, B x F
     """
     def forward(self, input_pcs):
-        feats = self.encoder(input_pcs.repeat(1, 1, 2))
-        feats = self.sample_encoder(feats)
+        feats = self.encoder(input_pcs)
         ret_list = dict()
         if self.conf.probabilistic:
-            feats, obj_kldiv_loss = torch.chunk(feats, 2, 1)
-            ret_list['kldiv_loss'] = -obj_kldiv_loss.sum(dim=1)
+            feats, obj_kldiv_loss = self.sample_encoder(feats)
+            ret_list['kldiv_loss'] = -obj_kldiv_loss
+        else:
+            feats = self.sample_encoder(feats)
         feats = self.sample_decoder(feats)
         output_pcs = self.decoder(feats)
         return output_pcs, feats, ret_list
 
     def get_loss(self, pc1, pc2):
         if self.conf.loss_type == 'cd':
-            dist1, dist2 = chamfer_distance(pc1, pc2, transpose=False)
+            if getattr(self.conf, 'legacy_cd', False):
+                dist1, dist2 = chamfer_distance(pc1, pc2, transpose=False)
+            else:
+                dist1, dist2 = chamfer_fast(pc1, pc2, transpose=False)
             loss_per_data = torch.mean(dist1, dim=1) + torch.mean(dist2, dim=1)
 
         elif self.conf.loss_type == 'emd':
-            loss_per_data = earth_mover_distance(pc1, pc2, transpose=False) / min(pc1.shape[1], pc2.shape[1])
+            if getattr(self.conf, 'emd_impl', 'approx') == 'sinkhorn':
+                loss_per_data = sinkhorn_emd(pc1, pc2, transpose=False) / min(pc1.shape[1], pc2.shape[1])
+            else:
+                loss_per_data = earth_mover_distance(pc1, pc2, transpose=False) / min(pc1.shape[1], pc2.shape[1])
 
         else:
             raise ValueError('ERROR: unknown loss_type %s!' % loss_type)
@@ -222,6 +270,7 @@ class CasualNetwork(nn.Module):
     def __init__(self, conf):
         super(CasualNetwork, self).__init__()
         self.conf = conf
+        conf.use_torch_fps = not ensure_cuda_ops()
         self.feat_dim = 64
         self.pn_encoder = PointNet(k=self.feat_dim, normal_channel=False)
         self.encoder = PointNet2({'feat_dim': self.feat_dim})
@@ -282,9 +331,9 @@ class CasualNetwork(nn.Module):
         Output: B x N x 3, B x F
     """
 
-    def forward(self, src_idx, dst_idx, src_pcs, dst_pcs):
-        src_feats = self.encoder(src_pcs.repeat(1, 1, 2))
-        dst_feats = self.encoder(dst_pcs.repeat(1, 1, 2))
+    def forward(self, src_idx, dst_idx, src_pcs, dst_pcs, src_fps_idxs=None, dst_fps_idxs=None):
+        src_feats = self.encoder(src_pcs, fps_idxs=src_fps_idxs)
+        dst_feats = self.encoder(dst_pcs, fps_idxs=dst_fps_idxs)
         feats = torch.cat((src_feats, dst_feats), dim=0)
         src_feats = self.src_sample_encoder(feats)
         src_feats = self.src_sample_decoder(src_feats)
@@ -308,25 +357,32 @@ class CasualNetwork(nn.Module):
         relation_loss = self.relation_loss_fn(relation, gt_relation.float())
         accuracy = ((relation >= 0.5) == gt_relation).float().mean()
 
-        full_loss = self.full_loss_fn(full, gt_full.float())
-        full_loss[~gt_relation] = 0
-
-        tgt_oh_pred = tgt_pred[gt_relation & ~gt_full] > 0.5
-        tgt_oh_gt = tgt_gt[gt_relation & ~gt_full] > 0.5
-        tgt_iou = ((tgt_oh_pred > 0.5) & (tgt_oh_gt > 0.5)).float().sum() / (((tgt_oh_pred > 0.5) | (tgt_oh_gt > 0.5)).float().sum() + 1e-8)
-        src_oh_pred = src_pred[gt_relation] > 0.5
-        src_oh_gt = src_gt[gt_relation] > 0.5
-        src_iou = ((src_oh_pred > 0.5) & (src_oh_gt > 0.5)).float().sum() / (((src_oh_pred > 0.5) | (src_oh_gt > 0.5)).float().sum() + 1e-8)
-        tgt_iou_loss = self.iou_loss_fn(tgt_pred, tgt_gt)
-        tgt_iou_loss[~gt_relation | gt_full] = 0
-        src_iou_loss = self.iou_loss_fn(src_pred, src_gt)
-        src_iou_loss[~gt_relation] = 0
+        # mask by multiplication instead of boolean indexing/assignment:
+        # every intermediate keeps a static shape and no nonzero() stream
+        # sync is needed, so the whole loss is CUDA-graph capturable
+        src_mask = gt_relation.float()
+        tgt_mask = (gt_relation & ~gt_full).float()
+
+        full_loss = self.full_loss_fn(full, gt_full.float()) * src_mask
+
+        tgt_oh_pred = tgt_pred > 0.5
+        tgt_oh_gt = tgt_gt > 0.5
+        tgt_inter = ((tgt_oh_pred & tgt_oh_gt).float().sum(-1) * tgt_mask).sum()
+        tgt_union = ((tgt_oh_pred | tgt_oh_gt).float().sum(-1) * tgt_mask).sum()
+        tgt_iou = tgt_inter / (tgt_union + 1e-8)
+        src_oh_pred = src_pred > 0.5
+        src_oh_gt = src_gt > 0.5
+        src_inter = ((src_oh_pred & src_oh_gt).float().sum(-1) * src_mask).sum()
+        src_union = ((src_oh_pred | src_oh_gt).float().sum(-1) * src_mask).sum()
+        src_iou = src_inter / (src_union + 1e-8)
+        tgt_iou_loss = self.iou_loss_fn(tgt_pred, tgt_gt) * tgt_mask
+        src_iou_loss = self.iou_loss_fn(src_pred, src_gt) * src_mask
         total_loss = relation_loss + full_loss + tgt_iou_loss + src_iou_loss
         return total_loss.mean(), accuracy, src_iou, tgt_iou
 
     def build_prior(self, indices, pcs):
         with torch.no_grad():
-            pc_feats = self.encoder(pcs.repeat(1, 1, 2))
+            pc_feats = self.encoder(pcs)
             pn_feats = self.pn_encoder(pcs.permute(0, 2, 1))
             prior_graph = torch.zeros(pcs.shape[0], pcs.shape[0]).to(pcs.device)
             for i in range(pcs.shape[0]):
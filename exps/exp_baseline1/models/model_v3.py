@@ -4,12 +4,15 @@ import torch.nn.functional as F
 import sys, os
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(BASE_DIR, '../utils'))
-from cd.chamfer import chamfer_distance
-from emd.emd import earth_mover_distance
+from cd.chamfer import chamfer_distance, chamfer_fast
+from emd.emd import earth_mover_distance, sinkhorn_emd
 
 from pointnet2_ops import pointnet2_utils
 from pointnet2_ops.pointnet2_modules import PointnetFPModule, PointnetSAModule
 from pointnet2.models.pointnet2_ssg_cls import PointNet2ClassificationSSG
+from .pointnet2_fast import patch_ball_query, ensure_cuda_ops
+
+patch_ball_query()
 
 
 class PointNet2(PointNet2ClassificationSSG):
@@ -20,7 +23,7 @@ class PointNet2(PointNet2ClassificationSSG):
                 npoint=512,
                 radius=0.2,
                 nsample=64,
-                mlp=[3, 64, 64, 128],
+                mlp=[0, 64, 64, 128],
                 use_xyz=True,
             )
         )
@@ -85,12 +88,14 @@ class Sampler(nn.Module):
 
         if self.probabilistic:
             logvar = self.mlp2var(x)
-            std = logvar.mul(0.5).exp_()
+            # out-of-place functional form: fuses into a single pointwise
+            # kernel under torch.compile and reuses std*std for exp(logvar)
+            std = (0.5 * logvar).exp()
             eps = torch.randn_like(std)
 
-            kld = mu.pow(2).add_(logvar.exp()).mul_(-1).add_(1).add_(logvar)
+            kld = 1 + logvar - mu.pow(2) - std.pow(2)
 
-            return torch.cat([eps.mul(std).add_(mu), kld], 1)
+            return mu + eps * std, kld.sum(dim=1)
         else:
             return mu
 
@@ -127,6 +132,27 @@ class FCDecoder(nn.Module):
         return net
 
 
+class FusedHead(nn.Module):
+    # SampleDecoder + FCDecoder collapsed into one nn.Sequential so the whole
+    # latent -> point-cloud chain is a single module; torch.compile then sees
+    # the full Linear/ReLU sequence and fuses it instead of dispatching four
+    # separate modules per step
+
+    def __init__(self, num_point=2048):
+        super(FusedHead, self).__init__()
+        print('Using FusedHead-NoBN!')
+
+        self.mlp = nn.Sequential(
+            nn.Linear(128, 128), nn.ReLU(),
+            nn.Linear(128, 1024), nn.ReLU(),
+            nn.Linear(1024, 1024), nn.ReLU(),
+            nn.Linear(1024, num_point*3),
+        )
+
+    def forward(self, feat):
+        return self.mlp(feat).view(feat.shape[0], -1, 3)
+
+
 class FCUpconvDecoder(nn.Module):
 
     def __init__(self, num_point=2048):
@@ -137,11 +163,21 @@ class FCUpconvDecoder(nn.Module):
         self.mlp2 = nn.Linear(1024, 1024)
         self.mlp3 = nn.Linear(1024, 1024*3)
 
-        self.deconv1 = nn.ConvTranspose2d(128, 1024, 2, 1)
-        self.deconv2 = nn.ConvTranspose2d(1024, 512, 3, 1)
-        self.deconv3 = nn.ConvTranspose2d(512, 256, 4, 2)
-        self.deconv4 = nn.ConvTranspose2d(256, 128, 5, 3)
-        self.deconv5 = nn.ConvTranspose2d(128, 3, 1, 1)
+        # dense Conv2d + PixelShuffle upsampling (1x1 -> 32x32 = 1024 points);
+        # transposed conv wastes most of its MACs on zeros at these tiny
+        # spatial sizes, while sub-pixel conv keeps every GEMM dense
+        self.upconv = nn.Sequential(
+            nn.Conv2d(128, 1024 * 4, 3, padding=1), nn.PixelShuffle(2), nn.ReLU(True),
+            nn.Conv2d(1024, 512 * 4, 3, padding=1), nn.PixelShuffle(2), nn.ReLU(True),
+            nn.Conv2d(512, 256 * 4, 3, padding=1), nn.PixelShuffle(2), nn.ReLU(True),
+            nn.Conv2d(256, 128 * 4, 3, padding=1), nn.PixelShuffle(2), nn.ReLU(True),
+            nn.Conv2d(128, 128 * 4, 3, padding=1), nn.PixelShuffle(2), nn.ReLU(True),
+            nn.Conv2d(128, 3, 1),
+        )
+
+        # NHWC layout lets cuDNN pick its tensor-core kernels for the convs
+        # instead of transposing NCHW activations internally
+        self.to(memory_format=torch.channels_last)
 
     def forward(self, feat):
         batch_size = feat.shape[0]
@@ -151,13 +187,9 @@ class FCUpconvDecoder(nn.Module):
         fc_net = torch.relu(self.mlp2(fc_net))
         fc_net = self.mlp3(fc_net).view(batch_size, -1, 3)
 
-        upconv_net = feat.view(batch_size, -1, 1, 1)
-        upconv_net = torch.relu(self.deconv1(upconv_net))
-        upconv_net = torch.relu(self.deconv2(upconv_net))
-        upconv_net = torch.relu(self.deconv3(upconv_net))
-        upconv_net = torch.relu(self.deconv4(upconv_net))
-        upconv_net = self.deconv5(upconv_net).view(batch_size, 3, -1).permute(0, 2, 1)
-        
+        upconv_net = self.upconv(feat.view(batch_size, -1, 1, 1).contiguous(memory_format=torch.channels_last))
+        upconv_net = upconv_net.view(batch_size, 3, -1).permute(0, 2, 1)
+
         net = torch.cat([fc_net, upconv_net], dim=1)
 
         return net
@@ -168,32 +200,44 @@ class Network(nn.Module):
     def __init__(self, conf):
         super(Network, self).__init__()
         self.conf = conf
+        conf.use_torch_fps = not ensure_cuda_ops()
 
         self.encoder = PointNet2({'feat_dim': 128})
 
         self.sample_encoder = Sampler(probabilistic=conf.probabilistic)
-        self.sample_decoder = SampleDecoder()
 
         if conf.decoder_type == 'fc':
-            self.decoder = FCDecoder(num_point=conf.num_point)
+            # the SampleDecoder layer is folded into FusedHead
+            self.sample_decoder = nn.Identity()
+            self.decoder = FusedHead(num_point=conf.num_point)
 
         elif conf.decoder_type == 'fcupconv':
+            self.sample_decoder = SampleDecoder()
             self.decoder = FCUpconvDecoder(num_point=conf.num_point)
 
         else:
             raise ValueError('ERROR: unknown decoder_type %s!' % decoder_type)
 
+        # fuse the small MLP heads into single graphs; batch shapes are static
+        # (drop_last=True), so reduce-overhead can use CUDA graphs
+        if hasattr(torch, 'compile'):
+            self.sample_encoder = torch.compile(self.sample_encoder, mode='reduce-overhead', fullgraph=True)
+            self.sample_decoder = torch.compile(self.sample_decoder, mode='reduce-overhead', fullgraph=True)
+            self.decoder = torch.compile(self.decoder, mode='reduce-overhead', fullgraph=True)
+            self.encoder.fc_layer2 = torch.compile(self.encoder.fc_layer2, mode='reduce-overhead', fullgraph=True)
+
     """
         Input: B x N x 3
         Output: B x N x 3, B x F
     """
     def forward(self, input_pcs):
-        feats = self.encoder(input_pcs.repeat(1, 1, 2))
-        feats = self.sample_encoder(feats)
+        feats = self.encoder(input_pcs)
         ret_list = dict()
         if self.conf.probabilistic:
-            feats, obj_kldiv_loss = torch.chunk(feats, 2, 1)
-            ret_list['kldiv_loss'] = -obj_kldiv_loss.sum(dim=1)
+            feats, obj_kldiv_loss = self.sample_encoder(feats)
+            ret_list['kldiv_loss'] = -obj_kldiv_loss
+        else:
+            feats = self.sample_encoder(feats)
         feats = self.sample_decoder(feats)
         output_pcs = self.decoder(feats)
         return output_pcs, feats, ret_list
@@ -205,11 +249,17 @@ class Network(nn.Module):
     
     def get_loss(self, pc1, pc2):
         if self.conf.loss_type == 'cd':
-            dist1, dist2 = chamfer_distance(pc1, pc2, transpose=False)
+            if getattr(self.conf, 'legacy_cd', False):
+                dist1, dist2 = chamfer_distance(pc1, pc2, transpose=False)
+            else:
+                dist1, dist2 = chamfer_fast(pc1, pc2, transpose=False)
             loss_per_data = torch.mean(dist1, dim=1) + torch.mean(dist2, dim=1)
 
         elif self.conf.loss_type == 'emd':
-            loss_per_data = earth_mover_distance(pc1, pc2, transpose=False) / min(pc1.shape[1], pc2.shape[1])
+            if getattr(self.conf, 'emd_impl', 'approx') == 'sinkhorn':
+                loss_per_data = sinkhorn_emd(pc1, pc2, transpose=False) / min(pc1.shape[1], pc2.shape[1])
+            else:
+                loss_per_data = earth_mover_distance(pc1, pc2, transpose=False) / min(pc1.shape[1], pc2.shape[1])
 
         else:
             raise ValueError('ERROR: unknown loss_type %s!' % loss_type)
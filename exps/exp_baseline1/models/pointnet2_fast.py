@@ -0,0 +1,107 @@
+"""
+    Pure-PyTorch fast paths for the pointnet2_ops CUDA kernels.
+
+    For the cloud sizes used here (N <= 2048, nsample <= 64) a cdist+topk
+    ball query is competitive with the custom kernel and keeps working on
+    GPU arches the pre-built kernels were not compiled for.
+"""
+import torch
+from pointnet2_ops import pointnet2_utils
+
+
+def knn_group(xyz_q, xyz_k, k):
+    # indices of the k nearest neighbors of each query point: B x nq x k
+    return torch.cdist(xyz_q, xyz_k).topk(k, dim=-1, largest=False, sorted=False).indices
+
+
+def ball_query_torch(radius, nsample, xyz, new_xyz):
+    # same contract as pointnet2_utils.ball_query: B x npoint x nsample int32
+    # indices into xyz; slots with no point inside the radius are filled with
+    # the nearest neighbor, mirroring the duplicate-fill of the CUDA kernel
+    dist, idx = torch.cdist(new_xyz, xyz).topk(nsample, dim=-1, largest=False, sorted=True)
+    idx = torch.where(dist > radius, idx[..., :1].expand_as(idx), idx)
+    return idx.int()
+
+
+_ball_query_cuda = pointnet2_utils.ball_query
+
+
+def _ball_query_dispatch(radius, nsample, xyz, new_xyz):
+    if nsample <= 128:
+        return ball_query_torch(radius, nsample, xyz, new_xyz)
+    return _ball_query_cuda(radius, nsample, xyz, new_xyz)
+
+
+def patch_ball_query():
+    # route moderate-nsample queries through the torch implementation; the
+    # QueryAndGroup groupers look ball_query up on pointnet2_utils at call
+    # time, so patching the module attribute covers all SA modules
+    pointnet2_utils.ball_query = _ball_query_dispatch
+
+
+def furthest_point_sample_torch(xyz, npoint):
+    # same contract as pointnet2_utils.furthest_point_sample:
+    # B x N x 3 -> B x npoint int32
+    batch_size, num_point, _ = xyz.shape
+    idx = torch.zeros(batch_size, npoint, dtype=torch.long, device=xyz.device)
+    dist = torch.full((batch_size, num_point), float('inf'), device=xyz.device)
+    farthest = torch.zeros(batch_size, dtype=torch.long, device=xyz.device)
+    batch = torch.arange(batch_size, device=xyz.device)
+    for i in range(npoint):
+        idx[:, i] = farthest
+        dist = torch.minimum(dist, ((xyz - xyz[batch, farthest].unsqueeze(1)) ** 2).sum(-1))
+        farthest = dist.argmax(-1)
+    return idx.int()
+
+
+def gather_operation_torch(features, idx):
+    # B x C x N features, B x npoint idx -> B x C x npoint
+    return features.gather(2, idx.long().unsqueeze(1).expand(-1, features.size(1), -1))
+
+
+def grouping_operation_torch(features, idx):
+    # B x C x N features, B x npoint x nsample idx -> B x C x npoint x nsample
+    batch_size, num_channel, _ = features.shape
+    npoint, nsample = idx.shape[1:]
+    flat_idx = idx.long().reshape(batch_size, 1, npoint * nsample).expand(-1, num_channel, -1)
+    return features.gather(2, flat_idx).view(batch_size, num_channel, npoint, nsample)
+
+
+def patch_torch_fallbacks():
+    # replace every custom kernel the SA modules touch with the torch
+    # implementations; gather-based ops differentiate through plain autograd
+    pointnet2_utils.ball_query = ball_query_torch
+    pointnet2_utils.furthest_point_sample = furthest_point_sample_torch
+    pointnet2_utils.gather_operation = gather_operation_torch
+    pointnet2_utils.grouping_operation = grouping_operation_torch
+
+
+_probe_result = None
+
+
+def ensure_cuda_ops():
+    """Probe the compiled pointnet2_ops kernels once; when they cannot run on
+        this device (e.g. binaries built for a different TORCH_CUDA_ARCH_LIST
+        raise 'no kernel image is available'), patch in the torch fallbacks so
+        training degrades to the portable path instead of crashing mid-step.
+        Returns True when the custom kernels are usable.
+    """
+    global _probe_result
+    if _probe_result is not None:
+        return _probe_result
+
+    ok = False
+    if torch.cuda.is_available():
+        try:
+            pointnet2_utils.furthest_point_sample(torch.zeros(1, 16, 3, device='cuda'), 4)
+            torch.cuda.synchronize()
+            ok = True
+        except RuntimeError:
+            ok = False
+
+    if not ok:
+        print('pointnet2_ops CUDA kernels unavailable on this device, using torch fallbacks')
+        patch_torch_fallbacks()
+
+    _probe_result = ok
+    return ok
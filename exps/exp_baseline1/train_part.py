@@ -7,6 +7,8 @@ import time
 import sys
 import shutil
 import random
+import functools
+from concurrent.futures import ProcessPoolExecutor, wait as futures_wait
 from time import strftime
 from argparse import ArgumentParser
 import numpy as np
@@ -25,22 +27,44 @@ import logging
 logger = logging.getLogger("trimesh")
 logger.setLevel(logging.ERROR)
 
+# lazily created pool that renders visu pngs off the training process
+_render_pool = None
+_render_futures = []
+_log_buffers = {'train': [], 'val': []}
+
+
+def _get_render_pool():
+    global _render_pool
+    if _render_pool is None:
+        _render_pool = ProcessPoolExecutor(max_workers=2)
+    return _render_pool
+
 
 def train(conf):
     # create training and validation datasets and data loaders
     train_dataset = CasualPartDataset(no_casual_num=0, self_casual_num=2, binary_casual_num=1)
     utils.printout(conf.flog, str(train_dataset))
+    # batches are stacked and copied to device inside the workers, so no
+    # pinning in the parent; CUDA requires spawned (not forked) workers
+    collate_fn = functools.partial(utils.collate_feats_to_device, device=conf.device)
+    num_workers = conf.num_workers if conf.num_workers is not None else utils.auto_num_workers(conf.batch_size)
+    utils.printout(conf.flog, f'Using {num_workers} dataloader workers')
+    mp_context = 'spawn' if conf.device.type == 'cuda' and num_workers > 0 else None
     train_dataloader = torch.utils.data.DataLoader(train_dataset, batch_size=conf.batch_size, shuffle=True,
                                                    pin_memory=False, \
-                                                   num_workers=conf.num_workers, drop_last=True,
-                                                   collate_fn=utils.collate_feats, worker_init_fn=utils.worker_init_fn)
+                                                   num_workers=num_workers, drop_last=True,
+                                                   collate_fn=collate_fn, worker_init_fn=utils.worker_init_fn,
+                                                   persistent_workers=num_workers > 0,
+                                                   multiprocessing_context=mp_context)
 
     val_dataset = CasualPartDataset(no_casual_num=0, self_casual_num=2, binary_casual_num=1)
     utils.printout(conf.flog, str(val_dataset))
     val_dataloader = torch.utils.data.DataLoader(val_dataset, batch_size=conf.batch_size, shuffle=False,
                                                  pin_memory=False, \
-                                                 num_workers=0, drop_last=True, collate_fn=utils.collate_feats,
-                                                 worker_init_fn=utils.worker_init_fn)
+                                                 num_workers=num_workers, drop_last=True, collate_fn=collate_fn,
+                                                 worker_init_fn=utils.worker_init_fn,
+                                                 persistent_workers=num_workers > 0,
+                                                 multiprocessing_context=mp_context)
 
     # load network model
     model_def = utils.get_model_module(conf.model_version)
@@ -51,11 +75,26 @@ def train(conf):
         network.load_state_dict(torch.load(conf.checkpoint))
     utils.printout(conf.flog, '\n' + str(network) + '\n')
 
+    # only pay for cross-rank BatchNorm stat sync when actually distributed
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        network = torch.nn.SyncBatchNorm.convert_sync_batchnorm(network)
+
     models = [network]
     model_names = ['network']
 
-    # create optimizers
-    network_opt = torch.optim.Adam(network.parameters(), lr=conf.lr, weight_decay=conf.weight_decay)
+    # send parameters to device (before the optimizer so fused Adam sees
+    # CUDA parameters at construction time)
+    for m in models:
+        m.to(conf.device)
+
+    # create optimizers; the fused Adam kernel batches all parameter updates
+    # into a single launch instead of a per-parameter Python loop
+    try:
+        network_opt = torch.optim.Adam(network.parameters(), lr=conf.lr, weight_decay=conf.weight_decay, fused=True)
+    except (RuntimeError, TypeError, ValueError):
+        # fused unsupported on this device/torch; foreach still batches the
+        # elementwise update math across parameters
+        network_opt = torch.optim.Adam(network.parameters(), lr=conf.lr, weight_decay=conf.weight_decay, foreach=True)
     optimizers = [network_opt]
     optimizer_names = ['network_opt']
 
@@ -72,9 +111,7 @@ def train(conf):
         train_writer = SummaryWriter(os.path.join(conf.exp_dir, 'train'))
         val_writer = SummaryWriter(os.path.join(conf.exp_dir, 'val'))
 
-    # send parameters to device
-    for m in models:
-        m.to(conf.device)
+    # send optimizer state to device (model parameters were moved above)
     for o in optimizers:
         utils.optimizer_to_device(o, conf.device)
 
@@ -85,6 +122,7 @@ def train(conf):
     last_train_console_log_step, last_val_console_log_step = None, None
     train_num_batch = len(train_dataloader)
     val_num_batch = len(val_dataloader)
+    graphed_step = None
 
     # train for every epoch
     for epoch in range(conf.epochs):
@@ -112,16 +150,25 @@ def train(conf):
             for m in models:
                 m.train()
 
+            # capture the static training step once, then just replay it
+            if conf.cuda_graph and graphed_step is None and conf.device.type == 'cuda':
+                utils.printout(conf.flog, 'Capturing CUDA graph of the training step ...... ')
+                graphed_step = GraphedTrainStep(network, network_opt, conf, batch)
+                utils.printout(conf.flog, 'DONE')
+
             # forward pass (including logging)
             total_loss = forward(batch=batch, network=network, conf=conf, is_val=False, \
                                  step=train_step, epoch=epoch, batch_ind=train_batch_ind, num_batch=train_num_batch,
                                  start_time=start_time, \
                                  log_console=log_console, log_tb=not conf.no_tb_log, tb_writer=train_writer,
-                                 lr=network_opt.param_groups[0]['lr'])
-
-            # optimize one step
-            network_opt.zero_grad()
-            total_loss.backward()
+                                 lr=network_opt.param_groups[0]['lr'], graphed_step=graphed_step)
+
+            # optimize one step (the graphed path already ran backward into
+            # the static grad buffers during replay, and must not zero them)
+            if graphed_step is None:
+                # set_to_none skips the per-parameter grad-zeroing kernels
+                network_opt.zero_grad(set_to_none=True)
+                total_loss.backward()
             network_opt.step()
             network_lr_scheduler.step()
 
@@ -159,8 +206,6 @@ def train(conf):
                                  start_time=start_time, \
                                  log_console=log_console, log_tb=not conf.no_tb_log, tb_writer=val_writer,
                                  lr=network_opt.param_groups[0]['lr'])
-        train_dataset.reset()
-        val_dataset.reset()
 
     # save the final models
     utils.printout(conf.flog, 'Saving final checkpoint ...... ')
@@ -169,27 +214,87 @@ def train(conf):
     utils.printout(conf.flog, 'DONE')
 
 
+def model_forward(batch, network, conf):
+    # prepare input (the collate_fn already stacked the batch and moved it
+    # to device inside the worker)
+    src_idx, dst_idx, src_pc, dst_pc, src_gt, dst_gt, \
+        src_fps_1, src_fps_2, dst_fps_1, dst_fps_2 = batch
+
+    # forward through the network in bf16 (halves memory traffic and uses
+    # tensor cores on Ampere+); losses below stay in fp32
+    # (cache_enabled=False keeps the region CUDA-graph capturable)
+    with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=conf.device.type == 'cuda',
+                        cache_enabled=False):
+        relation, full, src_pred, dst_pred = network(src_idx, dst_idx, src_pc, dst_pc,
+                                                     src_fps_idxs=(src_fps_1, src_fps_2),
+                                                     dst_fps_idxs=(dst_fps_1, dst_fps_2))  # B x N x 3, B x P
+    relation = relation.float()
+    full = full.float()
+    src_pred = src_pred.squeeze().float()
+    dst_pred = dst_pred.squeeze().float()
+
+    # for each type of loss, compute losses per data
+    loss, accuracy, src_iou, tgt_iou = network.get_loss(relation, full, src_pred, src_gt, dst_pred, dst_gt)
+
+    return loss, accuracy, src_iou, tgt_iou, relation, full, src_pred, dst_pred
+
+
+class GraphedTrainStep:
+    """ Captures the static forward+backward of one training step in a CUDA
+        graph and replays it with each batch copied into static input tensors,
+        collapsing the per-iteration kernel-launch overhead into a single
+        graph.replay(). Shapes are static (drop_last=True, fixed num_point).
+        The optimizer step stays eager so StepLR updates keep taking effect.
+        References:
+            https://pytorch.org/docs/stable/notes/cuda.html#cuda-graphs
+    """
+
+    def __init__(self, network, optimizer, conf, batch, num_warmup=3):
+        self.static_batch = [t.clone() for t in batch]
+
+        # warmup on a side stream so cuDNN autotuning and lazy allocations
+        # do not end up inside the capture
+        s = torch.cuda.Stream()
+        s.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(s):
+            for _ in range(num_warmup):
+                optimizer.zero_grad(set_to_none=True)
+                out = model_forward(self.static_batch, network, conf)
+                out[0].backward()
+        torch.cuda.current_stream().wait_stream(s)
+
+        # grads must be None at capture time so replay overwrites (rather
+        # than accumulates into) the static grad buffers
+        optimizer.zero_grad(set_to_none=True)
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            out = model_forward(self.static_batch, network, conf)
+            self.static_outs = out[:4]
+            out[0].backward()
+
+    def step(self, batch):
+        for static_t, t in zip(self.static_batch, batch):
+            static_t.copy_(t, non_blocking=True)
+        self.graph.replay()
+        return self.static_outs
+
+
 def forward(batch, network, conf, \
             is_val=False, step=None, epoch=None, batch_ind=0, num_batch=1, start_time=0, \
-            log_console=False, log_tb=False, tb_writer=None, lr=None):
-    # prepare input
-    src_idx, dst_idx, src_pc, dst_pc, src_gt, dst_gt = batch
-    src_idx = torch.stack(src_idx, dim=0).to(conf.device)
-    dst_idx = torch.stack(dst_idx, dim=0).to(conf.device)
-    src_pc = torch.stack(src_pc, dim=0).to(conf.device)
-    dst_pc = torch.stack(dst_pc, dim=0).to(conf.device)
-    src_gt = torch.stack(src_gt, dim=0).to(conf.device)
-    dst_gt = torch.stack(dst_gt, dim=0).to(conf.device)
+            log_console=False, log_tb=False, tb_writer=None, lr=None, graphed_step=None):
+    src_idx, dst_idx, src_pc, dst_pc, src_gt, dst_gt, \
+        src_fps_1, src_fps_2, dst_fps_1, dst_fps_2 = batch
 
     batch_size = src_pc.shape[0]
 
-    # forward through the network
-    relation, full, src_pred, dst_pred = network(src_idx, dst_idx, src_pc, dst_pc)  # B x N x 3, B x P
-    src_pred = src_pred.squeeze()
-    dst_pred = dst_pred.squeeze()
-
-    # for each type of loss, compute losses per data
-    loss, accuracy, src_iou, tgt_iou = network.get_loss(relation, full, src_pred, src_gt, dst_pred, dst_gt)
+    if graphed_step is not None and not is_val:
+        # visu only runs on val batches, so the graphed path only needs the
+        # scalar metrics
+        loss, accuracy, src_iou, tgt_iou = graphed_step.step(batch)
+        relation = full = src_pred = dst_pred = None
+    else:
+        loss, accuracy, src_iou, tgt_iou, relation, full, src_pred, dst_pred = \
+            model_forward(batch, network, conf)
 
     # display information
     data_split = 'train'
@@ -197,25 +302,46 @@ def forward(batch, network, conf, \
         data_split = 'val'
 
     with torch.no_grad():
-        # log to console
-        if log_console:
-            utils.printout(conf.flog, \
-                           f'''{strftime("%H:%M:%S", time.gmtime(time.time() - start_time)):>9s} '''
-                           f'''{epoch:>5.0f}/{conf.epochs:<5.0f} '''
-                           f'''{data_split:^10s} '''
-                           f'''{batch_ind:>5.0f}/{num_batch:<5.0f} '''
-                           f'''{100. * (1 + batch_ind + num_batch * epoch) / (num_batch * conf.epochs):>9.1f}%      '''
-                           f'''{lr:>5.2E} '''
-                           f'''{loss.item():>10.5f}'''
-                           f'''{accuracy.item():>10.5f}'''
-                           f'''{src_iou.item():>10.5f}'''
-                           f'''{tgt_iou.item():>10.5f}''')
-            conf.flog.flush()
-
-        # log to tensorboard
-        if log_tb and tb_writer is not None:
-            tb_writer.add_scalar('loss', loss.item(), step)
-            tb_writer.add_scalar('lr', lr, step)
+        # buffer the scalar metrics on device; every .item() forces a CUDA
+        # sync, so we only pay for one bulk copy per console-log interval
+        buf = _log_buffers[data_split]
+        buf.append((step, torch.stack([loss, accuracy, src_iou, tgt_iou]).detach()))
+        if len(buf) > 4096:
+            # console and tb logging both disabled: keep only the latest entry
+            del buf[:-1]
+
+        # flush whenever the console log fires, and also once per interval
+        # when console logging is off but the tensorboard writer still needs
+        # its per-step rows
+        flush = log_console or \
+                (log_tb and tb_writer is not None and len(buf) >= conf.console_log_interval)
+        if flush:
+            steps = [s for s, _ in buf]
+            rows = torch.stack([v for _, v in buf]).cpu().numpy()
+            buf.clear()
+            loss_v, accuracy_v, src_iou_v, tgt_iou_v = rows[-1]
+
+            # log to console
+            if log_console:
+                utils.printout(conf.flog, \
+                               f'''{strftime("%H:%M:%S", time.gmtime(time.time() - start_time)):>9s} '''
+                               f'''{epoch:>5.0f}/{conf.epochs:<5.0f} '''
+                               f'''{data_split:^10s} '''
+                               f'''{batch_ind:>5.0f}/{num_batch:<5.0f} '''
+                               f'''{100. * (1 + batch_ind + num_batch * epoch) / (num_batch * conf.epochs):>9.1f}%      '''
+                               f'''{lr:>5.2E} '''
+                               f'''{loss_v:>10.5f}'''
+                               f'''{accuracy_v:>10.5f}'''
+                               f'''{src_iou_v:>10.5f}'''
+                               f'''{tgt_iou_v:>10.5f}''')
+                conf.flog.flush()
+
+            # log to tensorboard: every buffered step keeps its own point,
+            # written in one batch at flush time
+            if log_tb and tb_writer is not None:
+                for s, row in zip(steps, rows):
+                    tb_writer.add_scalar('loss', row[0], s)
+                tb_writer.add_scalar('lr', lr, step)
 
         # gen visu
         if is_val and (not conf.no_visu) and epoch % conf.num_epoch_every_visu == 0:
@@ -235,28 +361,46 @@ def forward(batch, network, conf, \
             if batch_ind < conf.num_batch_every_visu:
                 utils.printout(conf.flog, 'Visualizing ...')
 
+                # one bulk D2H copy per tensor instead of per-element copies,
+                # then hand the matplotlib work to the background render pool
+                # so the GPU keeps training
+                src_pc_np = src_pc.cpu().numpy()
+                dst_pc_np = dst_pc.cpu().numpy()
+                src_gt_np = src_gt.bool().cpu().numpy()
+                dst_gt_np = dst_gt.bool().cpu().numpy()
+                relation_np = relation.cpu().numpy()
+                full_np = full.cpu().numpy()
+                src_pred_np = (src_pred >= 0.5).cpu().numpy()
+                dst_pred_np = (dst_pred >= 0.5).cpu().numpy()
+
+                pool = _get_render_pool()
                 for i in range(batch_size):
                     src_fn = 'data-src-%03d.png' % (batch_ind * batch_size + i)
                     dst_fn = 'data-dst-%03d.png' % (batch_ind * batch_size + i)
 
-                    # render_pts(os.path.join(input_pcs_dir, fn), input_pcs[i].cpu().numpy())
-                    # render_pts(os.path.join(output_pcs_dir, fn), output_pcs[i].cpu().numpy())
-                    # or to render using matplotlib
-                    utils.render_pc(os.path.join(input_pcs_dir, src_fn), src_pc[i].cpu().numpy(), src_gt[i].bool().cpu().numpy())
-                    utils.render_pc(os.path.join(input_pcs_dir, dst_fn), dst_pc[i].cpu().numpy(), dst_gt[i].bool().cpu().numpy())
+                    _render_futures.append(pool.submit(
+                        utils.render_pc, os.path.join(input_pcs_dir, src_fn), src_pc_np[i], src_gt_np[i]))
+                    _render_futures.append(pool.submit(
+                        utils.render_pc, os.path.join(input_pcs_dir, dst_fn), dst_pc_np[i], dst_gt_np[i]))
 
-                    if relation[i] < 0.5:
-                        utils.render_pc(os.path.join(output_pcs_dir, src_fn), src_pc[i].cpu().numpy(), np.zeros(src_pc[i].shape[0], dtype=bool))
-                        utils.render_pc(os.path.join(output_pcs_dir, dst_fn), dst_pc[i].cpu().numpy(), np.zeros(dst_pc[i].shape[0], dtype=bool))
+                    if relation_np[i] < 0.5:
+                        src_mask = np.zeros(src_pc_np[i].shape[0], dtype=bool)
+                        dst_mask = np.zeros(dst_pc_np[i].shape[0], dtype=bool)
                     else:
-                        utils.render_pc(os.path.join(output_pcs_dir, src_fn), src_pc[i].cpu().numpy(), (src_pred[i] >= 0.5).cpu().numpy())
-                        if full[i] >= 0.5:
-                            utils.render_pc(os.path.join(output_pcs_dir, dst_fn), dst_pc[i].cpu().numpy(), np.ones(dst_pc[i].shape[0], dtype=bool))
+                        src_mask = src_pred_np[i]
+                        if full_np[i] >= 0.5:
+                            dst_mask = np.ones(dst_pc_np[i].shape[0], dtype=bool)
                         else:
-                            utils.render_pc(os.path.join(output_pcs_dir, dst_fn), dst_pc[i].cpu().numpy(), (dst_pred[i] >= 0.5).cpu().numpy())
+                            dst_mask = dst_pred_np[i]
+                    _render_futures.append(pool.submit(
+                        utils.render_pc, os.path.join(output_pcs_dir, src_fn), src_pc_np[i], src_mask))
+                    _render_futures.append(pool.submit(
+                        utils.render_pc, os.path.join(output_pcs_dir, dst_fn), dst_pc_np[i], dst_mask))
 
             if batch_ind == conf.num_batch_every_visu - 1:
-                # visu html
+                # visu html (all renders must be on disk first)
+                futures_wait(_render_futures)
+                _render_futures.clear()
                 utils.printout(conf.flog, 'Generating html visualization ...')
                 sublist = 'input_pcs,output_pcs,info'
                 cmd = 'cd %s && python %s . 10 htmls %s %s > /dev/null' % (
@@ -298,11 +442,14 @@ if __name__ == '__main__':
     # training parameters
     parser.add_argument('--epochs', type=int, default=1000)
     parser.add_argument('--batch_size', type=int, default=16)
-    parser.add_argument('--num_workers', type=int, default=10)
+    parser.add_argument('--num_workers', type=int, default=None,
+                        help='number of dataloader workers [default: auto-detect from cpu count and batch size]')
     parser.add_argument('--lr', type=float, default=.001)
     parser.add_argument('--weight_decay', type=float, default=1e-5)
     parser.add_argument('--lr_decay_by', type=float, default=0.9)
     parser.add_argument('--lr_decay_every', type=float, default=5000)
+    parser.add_argument('--cuda_graph', action='store_true', default=False,
+                        help='capture the training step in a CUDA graph [default: False]')
 
     # loss weights
 
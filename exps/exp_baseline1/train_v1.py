@@ -273,6 +273,10 @@ if __name__ == '__main__':
     parser.add_argument('--num_point', type=int, default=2048)
     parser.add_argument('--decoder_type', type=str, default='fc')
     parser.add_argument('--loss_type', type=str, default='cd')
+    parser.add_argument('--legacy_cd', action='store_true', default=False,
+                        help='use the custom CUDA chamfer kernel instead of the cdist-based one [default: False]')
+    parser.add_argument('--emd_impl', type=str, default='approx', choices=['approx', 'sinkhorn'],
+                        help='emd implementation: custom CUDA approxmatch or batched torch sinkhorn [default: approx]')
     parser.add_argument('--kldiv_loss_weight', type=float, default=1e-4)
     parser.add_argument('--probabilistic', action='store_true', default=False, help='probabilistic [default: False]')
 
@@ -78,10 +78,45 @@ def get_model_module(model_version):
 def collate_feats(b):
     return list(zip(*b))
 
+# stack each feature into a batched tensor inside the worker so the
+# pin_memory thread can page-lock it (lists of tensors are not pinned)
+def collate_feats_stack(b):
+    return [torch.stack(x, dim=0) for x in zip(*b)]
+
+# stack and copy to device inside the worker so the H2D transfer runs
+# concurrently with the previous batch's backward pass
+# (use with functools.partial(collate_feats_to_device, device=...))
+def collate_feats_to_device(b, device):
+    return [torch.stack(x, dim=0).to(device, non_blocking=True) for x in zip(*b)]
+
 def collate_feats_with_none(b):
     b = filter (lambda x:x is not None, b)
     return list(zip(*b))
 
+# greedy farthest-point sampling on CPU; O(num_sample * N) in numpy, cheap
+# enough to run inside dataloader workers so the serial FPS stays off the GPU
+def farthest_point_sample_cpu(xyz, num_sample):
+    num_point = xyz.shape[0]
+    idx = np.zeros(num_sample, dtype=np.int64)
+    dist = np.full(num_point, np.inf)
+    farthest = 0
+    for i in range(num_sample):
+        idx[i] = farthest
+        dist = np.minimum(dist, ((xyz - xyz[farthest]) ** 2).sum(axis=1))
+        farthest = int(dist.argmax())
+    return idx
+
+# pick a DataLoader worker count that saturates the input pipeline without
+# oversubscribing the CPUs on small machines
+def auto_num_workers(batch_size):
+    cap = os.cpu_count() or 2
+    if torch.cuda.is_available():
+        # every worker owns its own CUDA context (collate copies to device
+        # in-worker) and train() runs two persistent loaders at this count,
+        # so cap hard instead of spawning one context per core
+        cap = min(cap, 4 * torch.cuda.device_count())
+    return min(cap, max(2, batch_size))
+
 def worker_init_fn(worker_id):
     """ The function is designed for pytorch multi-process dataloader.
         Note that we use the pytorch random generator to generate a base_seed.
@@ -92,6 +127,10 @@ def worker_init_fn(worker_id):
     base_seed = torch.IntTensor(1).random_().item()
     #print(worker_id, base_seed)
     np.random.seed(base_seed + worker_id)
+    worker_info = torch.utils.data.get_worker_info()
+    if worker_info is not None and hasattr(worker_info.dataset, 'seed'):
+        # give each worker's dataset copy its own persistent generator stream
+        worker_info.dataset.seed(base_seed + worker_id)
 
 # pc is N x 3, feat is B x 10-dim
 def transform_pc_batch(pc, feat, anchor=False):
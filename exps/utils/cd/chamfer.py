@@ -56,6 +56,40 @@ def chamfer_distance(xyz1, xyz2, transpose=True, sqrt=False, eps=1e-12):
     return dist1, dist2
 
 
+def chamfer_fast(xyz1, xyz2, transpose=True):
+    """Pure-PyTorch chamfer distance via batched matmul + min.
+
+    For moderate point counts the cuBLAS-backed pairwise distance beats the
+    custom kernel, runs on any device/arch, and benefits from autocast and
+    torch.compile fusion. Semantics match chamfer_distance with sqrt=False
+    (squared distances). The squared distances are computed directly as
+    |x|^2 + |y|^2 - 2<x, y> rather than through cdist: cdist's backward
+    divides by the distance and produces NaN gradients whenever an argmin
+    pair coincides exactly, which the custom kernel never did.
+
+    Args:
+        xyz1 (torch.Tensor): (b, 3, n1)
+        xyz2 (torch.Tensor): (b, 3, n2)
+        transpose (bool): whether to transpose inputs as it might be BCN format.
+
+    Returns:
+        dist1 (torch.Tensor): (b, n1)
+        dist2 (torch.Tensor): (b, n2)
+
+    """
+    if xyz1.dim() == 2:
+        xyz1 = xyz1.unsqueeze(0)
+    if xyz2.dim() == 2:
+        xyz2 = xyz2.unsqueeze(0)
+    if transpose:
+        xyz1 = xyz1.transpose(1, 2)
+        xyz2 = xyz2.transpose(1, 2)
+    sq1 = xyz1.pow(2).sum(-1)
+    sq2 = xyz2.pow(2).sum(-1)
+    d = (sq1.unsqueeze(2) + sq2.unsqueeze(1) - 2 * torch.bmm(xyz1, xyz2.transpose(1, 2))).clamp(min=0)
+    return d.min(dim=2).values, d.min(dim=1).values
+
+
 def nn_distance(xyz1, xyz2, transpose=True):
     """The interface to infer rather than train"""
     if xyz1.dim() == 2:
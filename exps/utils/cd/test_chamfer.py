@@ -2,7 +2,7 @@ import numpy as np
 import torch
 from torch.autograd import gradcheck
 
-from chamfer import chamfer_distance, nn_distance
+from chamfer import chamfer_distance, chamfer_fast, nn_distance
 
 
 def bpdist2(feature1, feature2, data_format='NWC'):
@@ -51,6 +51,33 @@ def test_chamfer_cpu():
     print(dist2_desired.device, dist2_desired.shape)
 
 
+def test_chamfer_fast_cpu():
+    # ---------------------------------------------------------------------------- #
+    # parity with the reference torch implementation (NWC format)
+    # ---------------------------------------------------------------------------- #
+    batch_size = 32
+    num_points = 2048
+    xyz1 = torch.rand(batch_size, num_points, 3).float()
+    xyz2 = torch.rand(batch_size, num_points, 3).float()
+
+    dist1_actual, dist2_actual = chamfer_fast(xyz1, xyz2, transpose=False)
+    dist1_desired, idx1_desired, dist2_desired, idx2_desired = nn_distance_torch(xyz1, xyz2, 'NWC')
+
+    np.testing.assert_allclose(dist1_actual.numpy(), dist1_desired.numpy(), atol=1e-5)
+    np.testing.assert_allclose(dist2_actual.numpy(), dist2_desired.numpy(), atol=1e-5)
+
+    # check backward: gradients must stay finite when an argmin pair
+    # coincides exactly (the cdist-based form produced NaN here)
+    batch_size = 2
+    num_points = 64
+    xyz1 = torch.rand(batch_size, num_points, 3).double()
+    xyz2 = xyz1.clone()
+    xyz1.requires_grad = True
+    dist1, dist2 = chamfer_fast(xyz1, xyz2, transpose=False)
+    (dist1.sum() + dist2.sum()).backward()
+    assert torch.isfinite(xyz1.grad).all()
+
+
 def test_chamfer():
     # ---------------------------------------------------------------------------- #
     # NWC format
@@ -134,3 +161,4 @@ def test_chamfer():
 
 #test_chamfer()
 test_chamfer_cpu()
+test_chamfer_fast_cpu()
@@ -1,3 +1,5 @@
+import math
+
 import torch
 import emd_cuda
 
@@ -44,3 +46,52 @@ def earth_mover_distance(xyz1, xyz2, transpose=True):
     cost = EarthMoverDistanceFunction.apply(xyz1, xyz2)
     return cost
 
+
+def sinkhorn_emd(xyz1, xyz2, eps=0.01, n_iter=50, transpose=True):
+    """Earth Mover Distance (entropic / Sinkhorn approximation)
+
+    Pure-PyTorch log-domain Sinkhorn with uniform marginals. Batches over b
+    with a handful of cuBLAS matmuls per iteration instead of the serial
+    per-cloud iterations of the custom kernel, differentiates through regular
+    autograd, and runs on any device. The cost matrix holds squared
+    distances (computed directly as |x|^2 + |y|^2 - 2<x, y>, matching the
+    matchcost of the custom kernel and keeping the backward finite for
+    coincident points) and the result is scaled by n1 to match the total
+    matching cost returned by earth_mover_distance.
+
+    Args:
+        xyz1 (torch.Tensor): (b, 3, n1)
+        xyz2 (torch.Tensor): (b, 3, n1)
+        eps (float): entropic regularization strength
+        n_iter (int): number of Sinkhorn iterations
+        transpose (bool): whether to transpose inputs as it might be BCN format.
+            Extensions only support BNC format.
+
+    Returns:
+        cost (torch.Tensor): (b)
+
+    """
+    if xyz1.dim() == 2:
+        xyz1 = xyz1.unsqueeze(0)
+    if xyz2.dim() == 2:
+        xyz2 = xyz2.unsqueeze(0)
+    if transpose:
+        xyz1 = xyz1.transpose(1, 2)
+        xyz2 = xyz2.transpose(1, 2)
+
+    sq1 = xyz1.pow(2).sum(-1)
+    sq2 = xyz2.pow(2).sum(-1)
+    cost = (sq1.unsqueeze(2) + sq2.unsqueeze(1) - 2 * torch.bmm(xyz1, xyz2.transpose(1, 2))).clamp(min=0)
+    b, n1, n2 = cost.shape
+    log_a = -math.log(n1)
+    log_b = -math.log(n2)
+
+    f = cost.new_zeros(b, n1)
+    g = cost.new_zeros(b, n2)
+    for _ in range(n_iter):
+        f = -eps * torch.logsumexp((g.unsqueeze(1) - cost) / eps + log_b, dim=2)
+        g = -eps * torch.logsumexp((f.unsqueeze(2) - cost) / eps + log_a, dim=1)
+
+    plan = torch.exp((f.unsqueeze(2) + g.unsqueeze(1) - cost) / eps + log_a + log_b)
+    return (plan * cost).sum(dim=(1, 2)) * n1
+
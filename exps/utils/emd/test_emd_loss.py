@@ -1,7 +1,7 @@
 import torch
 import numpy as np
 import time
-from emd import earth_mover_distance
+from emd import earth_mover_distance, sinkhorn_emd
 
 # gt
 p1 = torch.from_numpy(np.array([[[1.7, -0.1, 0.1], [0.1, 1.2, 0.3]]], dtype=np.float32)).cuda()
@@ -42,3 +42,24 @@ loss.backward()
 print(p1.grad)
 print(p2.grad)
 
+# sinkhorn
+p1 = torch.from_numpy(np.array([[[1.7, -0.1, 0.1], [0.1, 1.2, 0.3]]], dtype=np.float32)).cuda()
+p1 = p1.repeat(3, 1, 1)
+p2 = torch.from_numpy(np.array([[[0.3, 1.8, 0.2], [1.2, -0.2, 0.3]]], dtype=np.float32)).cuda()
+p2 = p2.repeat(3, 1, 1)
+p1.requires_grad = True
+p2.requires_grad = True
+
+d_sinkhorn = sinkhorn_emd(p1, p2, transpose=False)
+print(d_sinkhorn)
+
+# with a well-separated optimal matching the entropic plan is close to the
+# exact one, so the cost must agree with the approx kernel's matching cost
+np.testing.assert_allclose(d_sinkhorn.detach().cpu().numpy(), d.detach().cpu().numpy(), rtol=0.05)
+
+loss = d_sinkhorn[0] / 2 + d_sinkhorn[1] * 2 + d_sinkhorn[2] / 3
+loss.backward()
+print(p1.grad)
+print(p2.grad)
+assert torch.isfinite(p1.grad).all() and torch.isfinite(p2.grad).all()
+